@@ -1,45 +1,179 @@
 import os
 import re
 import json
-import hmac
+import time
 import hashlib
+import uuid
 import boto3
+import boto3.s3.transfer
 import botocore.config
-from datetime import datetime
+import orjson
+import msgspec
+import zstandard as zstd
+from cachetools import TTLCache
+from io import BytesIO
+from typing import Optional
+
+# ---------- JSON helpers ----------
+# orjson only handles 64-bit integers: it raises when dumping larger ones and
+# silently parses them as floats. Such payloads fall back to the stdlib json
+# module, which keeps them exact.
+_long_number_re = re.compile(r'[0-9]{19}')
+
+def _json_loads(text: str):
+    if _long_number_re.search(text):
+        return json.loads(text)
+    return orjson.loads(text)
+
+def _json_dumps(obj) -> bytes:
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
 
 # ---------- Redaction utils ----------
 _SECRET = os.environ.get("REDACTION_SECRET", "project-secret").encode()
 
-def _stable_tag(kind: str, text: str, n=6) -> str:
-    h = hmac.new(_SECRET, text.encode(), hashlib.sha256).hexdigest()[:n]
-    return f"[{kind}:{h}]"
+# RFC 2104 HMAC-SHA256 with the padded-key states hashed once at import.
+# Copying a primed hashlib object per tag skips the key setup and Python-level
+# dispatch that hmac.new redoes on every match.
+def _hmac_states(key: bytes):
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key.ljust(64, b"\0")
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    outer = hashlib.sha256(bytes(b ^ 0x5C for b in key))
+    return inner, outer
+
+_HMAC_INNER, _HMAC_OUTER = _hmac_states(_SECRET)
+
+def _stable_tags(items, n=6) -> list:
+    """Tag every (kind, UTF-8 bytes) pair in one tight loop over the primed states."""
+    inner_copy, outer_copy = _HMAC_INNER.copy, _HMAC_OUTER.copy
+    tags = []
+    for kind, data in items:
+        inner = inner_copy()
+        inner.update(data)
+        outer = outer_copy()
+        outer.update(inner.digest())
+        tags.append(f"[{kind}:{outer.hexdigest()[:n]}]".encode())
+    return tags
+
+# All PII patterns fused into one alternation so each string is scanned once.
+# At a given position the first alternative wins, so the order below is the
+# overlap priority (SSN > CARD > ACCT, URL > DOMAIN). The patterns avoid nested
+# quantifiers, and the e-mail local part and domain labels are bounded to
+# RFC/DNS limits (64 and 63 characters), so work per start position is bounded
+# and the backtracking engine stays linear on adversarial input.
+_PII_PATTERNS = [
+    ("EMAIL",  r'[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]+\.[A-Za-z]{2,}'),
+    ("SSN",    r'\b\d{3}-\d{2}-\d{4}\b'),
+    ("CARD",   r'\b\d(?:[ -]{0,3}\d){12,18}\b'),
+    ("ACCT",   r'\b\d{6,18}\b'),
+    ("IP",     r'\b(?:(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\b'),
+    ("URL",    r'(?i:\bhttps?://[^\s\x1c-\x1f]+\b)'),
+    ("DOMAIN", r'\b[A-Za-z0-9-]{1,63}(?:\.[A-Za-z0-9-]{1,63}){0,126}\.[A-Za-z]{2,63}\b'),
+]
+_PII_REGEX = "|".join(f"(?P<{kind}>{pat})" for kind, pat in _PII_PATTERNS)
+# str mode keeps Unicode \d/\b/\s, so full-width or Arabic-Indic digits are
+# still caught. ASCII-only input, where both modes agree, is scanned as bytes.
+_pii_re = re.compile(_PII_REGEX)
+_pii_re_ascii = re.compile(_PII_REGEX.encode())
+
+# Every PII pattern needs a digit, "." (email, domain) or ":" (URL).
+# Values without any of them (labels, enums, free text) skip the full scan.
+_pii_screen = re.compile(r'[\d.:]')
 
-_email_re  = re.compile(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}')
-_card_re   = re.compile(r'\b(?:\d[ -]*?){13,19}\b')
-_ssn_re    = re.compile(r'\b\d{3}-\d{2}-\d{4}\b')
-_acct_re   = re.compile(r'\b\d{6,18}\b')
-_ip_re     = re.compile(r'\b(?:(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\b')
-_url_re    = re.compile(r'\bhttps?://\S+\b', re.IGNORECASE)
-_domain_re = re.compile(r'\b([A-Za-z0-9-]+\.)+[A-Za-z]{2,}\b')
+def _scrub_unicode(s: str) -> str:
+    matches = [(m.lastgroup, m.start(), m.end()) for m in _pii_re.finditer(s)]
+    if not matches:
+        return s
+    tags = _stable_tags((kind, s[start:end].encode()) for kind, start, end in matches)
+    out = []
+    last = 0
+    for (_, start, end), tag in zip(matches, tags):
+        out.append(s[last:start])
+        out.append(tag.decode())
+        last = end
+    out.append(s[last:])
+    return "".join(out)
 
 def _scrub_str(s: str) -> str:
-    s = _email_re.sub(lambda m: _stable_tag("EMAIL", m.group()), s)
-    s = _ssn_re.sub(lambda m: _stable_tag("SSN", m.group()), s)
-    s = _card_re.sub(lambda m: _stable_tag("CARD", m.group()), s)
-    s = _acct_re.sub(lambda m: _stable_tag("ACCT", m.group()), s)
-    s = _ip_re.sub(lambda m: _stable_tag("IP", m.group()), s)
-    s = _url_re.sub(lambda m: _stable_tag("URL", m.group()), s)
-    s = _domain_re.sub(lambda m: _stable_tag("DOMAIN", m.group()), s)
-    return s
+    if not _pii_screen.search(s):
+        return s
+    if not s.isascii():
+        return _scrub_unicode(s)
+    raw = s.encode()
+    matches = [(m.lastgroup, m.start(), m.end()) for m in _pii_re_ascii.finditer(raw)]
+    if not matches:
+        return s
+    mv = memoryview(raw)
+    tags = _stable_tags((kind, mv[start:end]) for kind, start, end in matches)
+    # Copy untouched spans and tags straight into one output buffer
+    buf = bytearray()
+    last = 0
+    for (_, start, end), tag in zip(matches, tags):
+        buf += mv[last:start]
+        buf += tag
+        last = end
+    buf += mv[last:]
+    return buf.decode()
 
 def scrub(obj):
-    if obj is None: return None
+    """Scrub every string in a JSON-like tree. Dicts and lists are updated in place."""
     if isinstance(obj, str): return _scrub_str(obj)
-    if isinstance(obj, (int, float, bool)): return obj
-    if isinstance(obj, list): return [scrub(x) for x in obj]
-    if isinstance(obj, dict): return {k: scrub(v) for k, v in obj.items()}
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict): items = node.items()
+        elif isinstance(node, list): items = enumerate(node)
+        else: continue
+        for k, v in items:
+            if isinstance(v, str): node[k] = _scrub_str(v)
+            elif isinstance(v, (dict, list)): stack.append(v)
     return obj
 
+# Joins values for batch_scrub. It is not a word character and no pattern
+# can consume it, so matches never span two values.
+_BATCH_SEP = "\x1f"
+
+def batch_scrub(values: list) -> list:
+    """Scrub many strings with one scan over their separator-joined concatenation."""
+    todo = [i for i, v in enumerate(values) if _pii_screen.search(v)]
+    out = list(values)
+    if not todo:
+        return out
+    joined = _BATCH_SEP.join(values[i] for i in todo)
+    if joined.count(_BATCH_SEP) != len(todo) - 1:
+        # a value contains the separator itself; splitting would misalign
+        for i in todo:
+            out[i] = _scrub_str(values[i])
+        return out
+    for i, v in zip(todo, _scrub_str(joined).split(_BATCH_SEP)):
+        out[i] = v
+    return out
+
+def scrub_records(records: list) -> list:
+    """Scrub many JSON-like records with a single batch_scrub over all their strings.
+
+    Nested dicts and lists are updated in place.
+    """
+    out = list(records)
+    refs, values = [], []
+    stack = [out]
+    while stack:
+        node = stack.pop()
+        items = node.items() if isinstance(node, dict) else enumerate(node)
+        for k, v in items:
+            if isinstance(v, str):
+                refs.append((node, k))
+                values.append(v)
+            elif isinstance(v, (dict, list)):
+                stack.append(v)
+    for (node, k), v in zip(refs, batch_scrub(values)):
+        node[k] = v
+    return out
+
 ALLOWED_FIELDS = {
     "case_id", "summary", "timeline", "indicators",
     "amount_usd", "detected_by", "actions_taken", "date"
@@ -48,66 +182,211 @@ ALLOWED_FIELDS = {
 def allowlist(d: dict) -> dict:
     return {k: d[k] for k in d if k in ALLOWED_FIELDS}
 
+class BadRequestError(Exception):
+    """Caller input is invalid; lambda_handler answers 400 with the message."""
+
+def _load_allowed(security_detail_json) -> dict:
+    data = security_detail_json
+    if isinstance(data, str):
+        try:
+            data = _json_loads(data)
+        except ValueError as e:
+            raise BadRequestError(f"invalid security_detail_json: {e}")
+    return allowlist(data if isinstance(data, dict) else {})
+
 def make_safe_payload(security_detail_json) -> str:
-    data = json.loads(security_detail_json) if isinstance(security_detail_json, str) else security_detail_json
-    data = allowlist(data if isinstance(data, dict) else {})
-    data = scrub(data)
-    return json.dumps(data, ensure_ascii=False)
+    data = scrub(_load_allowed(security_detail_json))
+    return _json_dumps(data).decode()
 
 # ---------- Config / clients ----------
 REGION = "us-east-1"
 BUCKET = "sar-output-bucket"
 PROFILE_ARN = os.environ.get("INFERENCE_PROFILE_ARN")  # must be set
+BATCH_ROLE_ARN = os.environ.get("BATCH_ROLE_ARN")  # service role for batch inference jobs
+SAR_QUEUE_URL = os.environ.get("SAR_QUEUE_URL")  # optional: persist outputs via the SQS consumer
 
-bedrock = boto3.client(
-    "bedrock-runtime",
-    region_name=REGION,
-    config=botocore.config.Config(read_timeout=300, retries={'max_attempts': 3})
+# Shared by all clients; pooled keep-alive connections survive across warm
+# invocations so later requests skip the TCP/TLS handshake.
+BOTO_CONFIG = botocore.config.Config(
+    read_timeout=300,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    max_pool_connections=50
+)
+
+bedrock = boto3.client("bedrock-runtime", region_name=REGION, config=BOTO_CONFIG)
+bedrock_jobs = boto3.client("bedrock", region_name=REGION, config=BOTO_CONFIG)
+s3 = boto3.client("s3", config=BOTO_CONFIG)
+sqs = boto3.client("sqs", region_name=REGION, config=BOTO_CONFIG)
+
+# Bodies above the threshold go up as parallel multipart parts instead of one PUT
+MULTIPART_THRESHOLD = 5 * 1024 * 1024
+_transfer = boto3.s3.transfer.create_transfer_manager(
+    s3,
+    boto3.s3.transfer.TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_THRESHOLD,
+        max_concurrency=8,
+        use_threads=True
+    )
 )
-s3 = boto3.client("s3")
 
 # ---------- Core ----------
+def _utc_stamp() -> str:
+    t = time.gmtime(time.time_ns() // 1_000_000_000)
+    return f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}T{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}Z"
+
+GEN_PARAMS = {"max_gen_len": 512, "temperature": 0.25, "top_p": 0.9}
+
 def _normalize(text: str) -> str:
     return text.replace("\n", " ").replace("*", "").strip()
 
-def sar_generate_using_bedrock(security_detail_json) -> str:
-    safe_json = make_safe_payload(security_detail_json)
-
-    prompt = f"""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+# Static halves of the Llama 3 chat prompt around the redacted JSON
+_PROMPT_HEAD = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
 You are an AML compliance analyst writing lawful SAR summaries. Output must be plain English with no markdown and no line breaks. Return a single, continuous paragraph.
 <|eot_id|><|start_header_id|>user<|end_header_id|>
 Write a concise SAR narrative (<=300 words) from this JSON. Include who, what, when, where, how, why, detection source, and amounts. End with one sentence stating the report date, amount (if any), and main entity.
 JSON Input:
-{safe_json}
+"""
+_PROMPT_TAIL = """
 <|eot_id|><|start_header_id|>assistant<|end_header_id|>"""
 
+# invoke_model body pre-serialized around the open "prompt" string, so each
+# call only JSON-escapes the payload and concatenates bytes
+_BODY_HEAD = b'{"prompt":' + orjson.dumps(_PROMPT_HEAD)[:-1]
+_BODY_TAIL = orjson.dumps(_PROMPT_TAIL)[1:] + b"," + orjson.dumps(GEN_PARAMS)[1:]
+
+def _build_prompt(safe_json: str) -> str:
+    return _PROMPT_HEAD + safe_json + _PROMPT_TAIL
+
+def _build_body(safe_json: str) -> bytes:
+    return _BODY_HEAD + orjson.dumps(safe_json)[1:-1] + _BODY_TAIL
+
+# Only "generation" is read from the model response; msgspec skips the other
+# fields while decoding instead of building objects for them.
+class _Generation(msgspec.Struct):
+    generation: Optional[str] = None
+
+_generation_decoder = msgspec.json.Decoder(_Generation)
+
+# Narratives keyed by a hash of the redacted payload; survives across warm
+# invocations so replays and retries of the same case skip Bedrock.
+_narrative_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+def sar_generate_using_bedrock(security_detail_json) -> str:
+    safe_json = make_safe_payload(security_detail_json)
+
+    cache_key = hashlib.blake2b(safe_json.encode(), digest_size=16).digest()
+    cached = _narrative_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     if not PROFILE_ARN:
         raise RuntimeError("INFERENCE_PROFILE_ARN not set")
 
-    body = {"prompt": prompt, "max_gen_len": 512, "temperature": 0.25, "top_p": 0.9}
-
     resp = bedrock.invoke_model(
         modelId=PROFILE_ARN,           # using profile ARN as modelId (SDK-compat hack)
-        body=json.dumps(body),
+        body=_build_body(safe_json),
         contentType="application/json",
         accept="application/json"
     )
-    data = json.loads(resp["body"].read())
-    return _normalize((data.get("generation") or ""))
+    data = _generation_decoder.decode(resp["body"].read())
+    narrative = _normalize((data.generation or ""))
+    if narrative:
+        _narrative_cache[cache_key] = narrative
+    return narrative
 
-def save_sar_to_s3(obj: dict, key: str):
+# Bedrock batch inference record limits per job
+BATCH_MIN_RECORDS = 100
+BATCH_MAX_RECORDS = 50_000
+
+def submit_sar_batch_job(security_detail_jsons: list) -> dict:
+    """Queue many SARs as one Bedrock batch inference job (offline, batch pricing).
+
+    Prompts are written as JSONL to S3; Bedrock writes the generations under
+    sar-batch-output/. Returns the job ARN and the record id of each case.
+    """
+    if not isinstance(security_detail_jsons, list) or not (
+        BATCH_MIN_RECORDS <= len(security_detail_jsons) <= BATCH_MAX_RECORDS
+    ):
+        raise BadRequestError(f"security_detail_jsons must be a list of {BATCH_MIN_RECORDS}-{BATCH_MAX_RECORDS} cases")
+    if not PROFILE_ARN:
+        raise RuntimeError("INFERENCE_PROFILE_ARN not set")
+    if not BATCH_ROLE_ARN:
+        raise RuntimeError("BATCH_ROLE_ARN not set")
+
+    ts = _utc_stamp()
+    job_name = f"sar-batch-{ts}-{uuid.uuid4().hex[:8]}"
+    input_key = f"sar-batch-input/{job_name}.jsonl"
+
+    # scrub every case in one pass instead of one scan per record
+    safe = scrub_records([_load_allowed(sec) for sec in security_detail_jsons])
+
+    records, lines = [], []
+    for i, (sec, data) in enumerate(zip(security_detail_jsons, safe)):
+        record_id = f"REC{i:08d}"
+        prompt = _build_prompt(_json_dumps(data).decode())
+        lines.append(orjson.dumps({"recordId": record_id, "modelInput": {"prompt": prompt, **GEN_PARAMS}}))
+        records.append({"record_id": record_id, "case_id": _extract_case_id(sec)})
+
+    _upload_to_s3(b"\n".join(lines), input_key, "application/jsonl")
+
+    job = bedrock_jobs.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=BATCH_ROLE_ARN,
+        modelId=PROFILE_ARN,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{BUCKET}/{input_key}", "s3InputFormat": "JSONL"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{BUCKET}/sar-batch-output/"}},
+    )
+    return {"job_arn": job["jobArn"], "records": records}
+
+def get_sar_batch_job_status(job_arn: str) -> str:
+    return bedrock_jobs.get_model_invocation_job(jobIdentifier=job_arn)["status"]
+
+def _upload_to_s3(body: bytes, key: str, content_type: str, content_encoding: Optional[str] = None):
+    extra = {"ContentType": content_type}
+    if content_encoding:
+        extra["ContentEncoding"] = content_encoding
+    if len(body) > MULTIPART_THRESHOLD:
+        _transfer.upload(
+            fileobj=BytesIO(body),
+            bucket=BUCKET,
+            key=key,
+            extra_args=extra
+        ).result()
+        return
     s3.put_object(
         Bucket=BUCKET,
         Key=key,
-        Body=json.dumps(obj, ensure_ascii=False).encode("utf-8"),
-        ContentType="application/json"
+        Body=body,
+        **extra
     )
 
+# SAR JSON compresses several-fold; level 3 keeps compression well above
+# upload bandwidth. Readers must zstd-decode (ContentEncoding: zstd).
+_zstd = zstd.ZstdCompressor(level=3)
+
+def save_sar_to_s3(obj: dict, key: str):
+    _upload_to_s3(_zstd.compress(_json_dumps(obj)), key, "application/json", "zstd")
+
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+
+def enqueue_sar_for_s3(obj: dict, key: str):
+    """Hand the S3 write to sqs_consumer_handler, off the request path.
+
+    Writes directly when no queue is configured or the message is too large.
+    """
+    msg = _json_dumps({"key": key, "sar": obj})
+    if not SAR_QUEUE_URL or len(msg) > SQS_MAX_MESSAGE_BYTES:
+        save_sar_to_s3(obj, key)
+        return
+    sqs.send_message(QueueUrl=SAR_QUEUE_URL, MessageBody=msg.decode())
+
 def _parse_body(event):
     body = event.get("body")
     if isinstance(body, str):
         try:
-            return json.loads(body)
+            return _json_loads(body)
         except Exception:
             return {}
     return body if isinstance(body, dict) else {}
@@ -117,7 +396,7 @@ def _extract_case_id(sec):
         return sec.get("case_id") or "NA"
     if isinstance(sec, str):
         try:
-            return (json.loads(sec).get("case_id") or "NA")
+            return (_json_loads(sec).get("case_id") or "NA")
         except Exception:
             return "NA"
     return "NA"
@@ -125,25 +404,46 @@ def _extract_case_id(sec):
 def lambda_handler(event, context):
     try:
         payload = _parse_body(event)
+
+        # batch submission: many cases -> one Bedrock batch inference job
+        if "security_detail_jsons" in payload:
+            job = submit_sar_batch_job(payload["security_detail_jsons"])
+            print(f"status=batch_submitted records={len(job['records'])} job={job['job_arn']}")
+            return {"statusCode": 202, "body": _json_dumps(job).decode()}
+
+        # batch polling
+        if "job_arn" in payload:
+            status = get_sar_batch_job_status(payload["job_arn"])
+            return {"statusCode": 200, "body": orjson.dumps({"job_arn": payload["job_arn"], "status": status}).decode()}
+
         sec = payload["security_detail_json"]
 
         narrative = sar_generate_using_bedrock(sec)
         if not narrative:
-            return {"statusCode": 502, "body": json.dumps({"error": "model returned empty generation"})}
+            return {"statusCode": 502, "body": orjson.dumps({"error": "model returned empty generation"}).decode()}
 
-        ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        ts = _utc_stamp()
         case_id = _extract_case_id(sec)
         key = f"sar-output/{case_id}/{ts}.json"
 
         out = {"case_id": case_id, "timestamp": ts, "model": "meta.llama3-2-1b-instruct (profile)", "narrative": narrative}
-        save_sar_to_s3(out, key)
+        enqueue_sar_for_s3(out, key)
 
         # metadata-only log
         print(f"case={case_id} status=ok s3_key={key}")
-        return {"statusCode": 200, "body": json.dumps({"s3_key": key, "narrative": narrative})}
+        return {"statusCode": 200, "body": orjson.dumps({"s3_key": key, "narrative": narrative}).decode()}
 
     except KeyError as e:
-        return {"statusCode": 400, "body": json.dumps({"error": f"missing field: {str(e)}"})}
+        return {"statusCode": 400, "body": orjson.dumps({"error": f"missing field: {str(e)}"}).decode()}
+    except BadRequestError as e:
+        return {"statusCode": 400, "body": orjson.dumps({"error": str(e)}).decode()}
     except Exception as e:
         print(f"status=error err={e}")
-        return {"statusCode": 502, "body": json.dumps({"error": "internal"})}
+        return {"statusCode": 502, "body": orjson.dumps({"error": "internal"}).decode()}
+
+def sqs_consumer_handler(event, context):
+    # raising fails the whole batch so SQS redelivers it
+    for record in event.get("Records", []):
+        msg = _json_loads(record["body"])
+        save_sar_to_s3(msg["sar"], msg["key"])
+        print(f"status=stored s3_key={msg['key']}")
@@ -1,23 +1,30 @@
 import os
 import json
-from datetime import datetime
+import time
+import asyncio
+import hashlib
+import uuid
+from typing import List
+from functools import lru_cache
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import orjson
+import msgspec
+import zstandard as zstd
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from dotenv import load_dotenv
 
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient
 
 # -------------------- ENV SETUP --------------------
 load_dotenv()
 
-# -------------------- FASTAPI APP --------------------
-app = FastAPI(title="AutoSAR – AML Narrative Generator")
-
 # -------------------- SENSITIVE KEYS --------------------
-SENSITIVE_KEYS = {
+SENSITIVE_KEYS = frozenset({
     "account_id",
     "account_number",
     "card_number",
@@ -29,31 +36,40 @@ SENSITIVE_KEYS = {
     "name",
     "linked_accounts",
     "transaction_id",
-}
+})
+MAX_SENSITIVE_KEY_LEN = max(map(len, SENSITIVE_KEYS))
 
-# -------------------- JSON REDACTION --------------------
-def local_guardrail_redact_json(raw_json: str) -> str:
-    data = json.loads(raw_json)
+# Payloads repeat the same keys across records, so the lowercase check is
+# memoised instead of allocating k.lower() for every key at every level.
+@lru_cache(maxsize=4096)
+def is_sensitive_key(key: str) -> bool:
+    return key.lower() in SENSITIVE_KEYS
+
+# -------------------- JSON SERIALIZATION --------------------
+def dumps_json(obj) -> bytes:
+    # orjson rejects integers outside 64 bits; stdlib json keeps them exact
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
 
-    def redact(obj):
+# -------------------- JSON REDACTION --------------------
+def redact_obj(data: dict) -> dict:
+    # Iterative walk over the already-parsed request body; sensitive values
+    # are overwritten in place instead of rebuilding every dict and list.
+    stack = [data]
+    while stack:
+        obj = stack.pop()
         if isinstance(obj, dict):
-            result = {}
             for k, v in obj.items():
-                key_lower = k.lower()
-                if key_lower in SENSITIVE_KEYS:
-                    result[k] = f"[{k.upper()}_REDACTED]"
-                else:
-                    result[k] = redact(v)
-            return result
+                if len(k) <= MAX_SENSITIVE_KEY_LEN and is_sensitive_key(k):
+                    obj[k] = f"[{k.upper()}_REDACTED]"
+                elif isinstance(v, (dict, list)):
+                    stack.append(v)
         elif isinstance(obj, list):
-            return [redact(x) for x in obj]
-        elif isinstance(obj, str):
-            #redact any embedded account numbers or emails inside strings
-            return obj
-        else:
-            return obj
+            stack.extend(x for x in obj if isinstance(x, (dict, list)))
 
-    return json.dumps(redact(data), indent=2)
+    return data
 
 
 
@@ -85,62 +101,190 @@ prompt = ChatPromptTemplate.from_messages([
 
 chain = prompt | llm
 
-# -------------------- AZURE BLOB STORAGE --------------------
-def save_to_azure_blob_json(filename: str, data: dict):
-    conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    blob_service_client = BlobServiceClient.from_connection_string(conn_str)
+# Upper bounds on cases per batch request and concurrent LLM calls for it
+MAX_BATCH_SIZE = 64
+BATCH_MAX_CONCURRENCY = 32
+
+# -------------------- NARRATIVE CACHE --------------------
+# Replayed or retried cases redact to identical JSON, so the narrative is
+# cached by a hash of the redacted payload and the LLM call is skipped.
+narrative_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+def narrative_cache_key(safe_json: str) -> bytes:
+    return hashlib.blake2b(safe_json.encode(), digest_size=16).digest()
+
+async def generate_narrative(safe_json: str) -> str:
+    key = narrative_cache_key(safe_json)
+    narrative = narrative_cache.get(key)
+    if narrative is None:
+        response = await chain.ainvoke({"data": safe_json})
+        narrative = response.content
+        if narrative:
+            narrative_cache[key] = narrative
+    return narrative
+
+async def generate_narratives(safe_jsons: List[str]) -> list:
+    """Return one narrative per payload, or the exception its LLM call raised.
 
-    container_name = "sarnarratives"
+    A failed call does not discard the others; successful narratives are
+    cached either way.
+    """
+    keys = [narrative_cache_key(safe_json) for safe_json in safe_jsons]
+    narratives = [narrative_cache.get(key) for key in keys]
+    misses = [i for i, narrative in enumerate(narratives) if narrative is None]
+    if misses:
+        responses = await chain.abatch(
+            [{"data": safe_jsons[i]} for i in misses],
+            config={"max_concurrency": BATCH_MAX_CONCURRENCY},
+            return_exceptions=True
+        )
+        for i, response in zip(misses, responses):
+            if isinstance(response, Exception):
+                narratives[i] = response
+                continue
+            narratives[i] = response.content
+            if narratives[i]:
+                narrative_cache[keys[i]] = narratives[i]
+    return narratives
+
+# -------------------- AZURE BLOB STORAGE (ONCE) --------------------
+CONTAINER_NAME = "sarnarratives"
+
+blob_service_client = BlobServiceClient.from_connection_string(
+    os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+)
+container_client = blob_service_client.get_container_client(CONTAINER_NAME)
+
+async def ensure_container():
     try:
-        blob_service_client.create_container(container_name)
+        await container_client.create_container()
     except Exception as e:
-        
         if "ContainerAlreadyExists" not in str(e):
             raise
-    
-    blob_client = blob_service_client.get_blob_client(
-        container="sarnarratives",
-        blob=filename
-    )
 
-    blob_client.upload_blob(
-        json.dumps(data, indent=2),
-        overwrite=True
+async def close_blob_client():
+    await blob_service_client.close()
+
+# Stored blobs are zstd-compressed compact JSON (Content-Encoding: zstd)
+blob_compressor = zstd.ZstdCompressor(level=3)
+blob_content_settings = ContentSettings(content_type="application/json", content_encoding="zstd")
+
+async def save_to_azure_blob_json(filename: str, data: dict):
+    await container_client.get_blob_client(filename).upload_blob(
+        blob_compressor.compress(dumps_json(data)),
+        overwrite=True,
+        content_settings=blob_content_settings
     )
 
+async def save_all_to_azure_blob_json(outputs: List[tuple]):
+    await asyncio.gather(*(save_to_azure_blob_json(fn, data) for fn, data in outputs))
+
+# -------------------- TIMESTAMPS --------------------
+def utc_timestamps():
+    """Return (ISO-8601 UTC timestamp, filename stamp) from a single clock read."""
+    ns = time.time_ns()
+    t = time.gmtime(ns // 1_000_000_000)
+    us = ns // 1_000 % 1_000_000
+    iso = (f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+           f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}.{us:06d}Z")
+    stamp = (f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}"
+             f"_{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}")
+    return iso, stamp
+
+# -------------------- FASTAPI APP --------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_container()
+    yield
+    await close_blob_client()
+
+app = FastAPI(title="AutoSAR – AML Narrative Generator", lifespan=lifespan)
+
 # -------------------- API SCHEMAS --------------------
-class SARRequest(BaseModel):
+# msgspec decodes and validates straight from the raw body in C, skipping
+# FastAPI's pydantic model parsing for this small, fixed schema.
+class SARRequest(msgspec.Struct):
     transaction: dict
 
+async def decode_body(request: Request, schema):
+    try:
+        return msgspec.json.decode(await request.body(), type=schema)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
 # -------------------- API ENDPOINT --------------------
 
 @app.post("/generate-and-store")
-def generate_and_store(req: SARRequest):
+async def generate_and_store(request: Request, background_tasks: BackgroundTasks):
+    req = await decode_body(request, SARRequest)
     try:
         # Redact sensitive data
-        raw_json = json.dumps(req.transaction)
-        safe_json = local_guardrail_redact_json(raw_json)
+        safe_json = dumps_json(redact_obj(req.transaction)).decode()
         
         # Generate narrative
-        response = chain.invoke({"data": safe_json})
+        narrative = await generate_narrative(safe_json)
 
         # Prepare output
+        generated_at, stamp = utc_timestamps()
         sar_output = {
-            "narrative": response.content,
+            "narrative": narrative,
             "redacted_input": safe_json,
-            "generated_at": datetime.utcnow().isoformat(),
+            "generated_at": generated_at,
             "model": "gpt-4.1-mini"
         }
 
-        # Store to Azure Blob
-        filename = f"sar_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-        save_to_azure_blob_json(filename, sar_output)
+        # Store to Azure Blob after the response is sent
+        filename = f"sar_{stamp}.json"
+        background_tasks.add_task(save_to_azure_blob_json, filename, sar_output)
 
         return {
-            "status": "stored",
+            "status": "queued",
             "filename": filename,
             "narrative": sar_output["narrative"]
         }
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/generate-and-store-batch")
+async def generate_and_store_batch(request: Request, background_tasks: BackgroundTasks):
+    reqs = await decode_body(request, List[SARRequest])
+    if len(reqs) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=422, detail=f"batch exceeds {MAX_BATCH_SIZE} cases")
+    try:
+        # Redact sensitive data
+        safe_jsons = [dumps_json(redact_obj(r.transaction)).decode() for r in reqs]
+
+        # Generate all narratives concurrently
+        narratives = await generate_narratives(safe_jsons)
+
+        # Prepare outputs
+        generated_at, stamp = utc_timestamps()
+        # unique per request so concurrent batches never overwrite each other's blobs
+        batch_id = uuid.uuid4().hex[:8]
+        outputs, results = [], []
+        for i, (safe_json, narrative) in enumerate(zip(safe_jsons, narratives)):
+            if isinstance(narrative, Exception):
+                results.append({"error": str(narrative)})
+                continue
+            sar_output = {
+                "narrative": narrative,
+                "redacted_input": safe_json,
+                "generated_at": generated_at,
+                "model": "gpt-4.1-mini"
+            }
+            filename = f"sar_{stamp}_{batch_id}_{i:03d}.json"
+            outputs.append((filename, sar_output))
+            results.append({"filename": filename, "narrative": narrative})
+
+        # Store to Azure Blob after the response is sent
+        background_tasks.add_task(save_all_to_azure_blob_json, outputs)
+
+        return {
+            "status": "queued",
+            "results": results
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))